@@ -1,29 +1,51 @@
+import os
 import time
 import foxglove
 from foxglove.channels import CompressedVideoChannel
+from foxglove.mcap import MCAPCompression, MCAPWriteOptions
 from foxglove.schemas import CompressedVideo, Timestamp
 import json
 import gi
 gi.require_version("Gst", "1.0")
-from gi.repository import Gst, GLib
+gi.require_version("GstApp", "1.0")
+from gi.repository import Gst, GstApp, GLib
 import argparse
 
 
 parser = argparse.ArgumentParser(description="Capture webcam video to MCAP file using Foxglove SDK and GStreamer")
 parser.add_argument("-m", "--mac", action="store_true", help="run the macos pipeline")
-parser.add_argument("--dual", action="store_true", help="start two pipelines:")
+parser.add_argument("--dual", action="store_true", help="capture cameras 0 and 1, each to its own MCAP file and live server (camera N on port 8765 + N)")
+parser.add_argument("--nvenc", action="store_true", help="run the desktop linux pipeline with NVENC hardware encoding")
 args = parser.parse_args()
 
 Gst.init(None)
 
+# h264parse config-interval=-1 puts SPS/PPS in front of every IDR frame and nowhere
+# else. Foxglove needs them on each keyframe to start decoding there, so they are
+# not stripped from the logged access units.
+
+# avfvideosrc can hand NV12 straight to VideoToolbox, so there is no CPU colour
+# conversion and no software encode on macOS.
 pipeline_str_mac = f"""
 avfvideosrc device-index={{idx}} !
-video/x-raw,format=UYVY,width=1280,height=720,framerate=15/1 !
+video/x-raw,format=NV12,width=1280,height=720,framerate=15/1 !
+vtenc_h264_hw realtime=true allow-frame-reordering=false bitrate=4000 !
+h264parse config-interval=-1 !
+video/x-h264,stream-format=byte-stream,alignment=au !
+appsink name=sink{{idx}} emit-signals=true max-buffers=1 drop=true
+"""
+
+# Desktop Linux with an NVIDIA GPU: encode on NVENC instead of x264. P4 with the
+# ultra-low-latency tune and no B-frames keeps encode latency down for live recording.
+pipeline_str_nvenc = f"""
+v4l2src device=/dev/video{{idx}} !
+video/x-raw,width=1280,height=720,framerate=15/1 !
 videoconvert !
-x264enc tune=zerolatency bitrate=4000 speed-preset=veryfast !
-h264parse config-interval=1 !
+video/x-raw,format=NV12 !
+nvh264enc preset=p4 tune=ultra-low-latency rc-mode=cbr bitrate=4000 bframes=0 zerolatency=true !
+h264parse config-interval=-1 !
 video/x-h264,stream-format=byte-stream,alignment=au !
-appsink name=sink emit-signals=true max-buffers=1 drop=true
+appsink name=sink{{idx}} emit-signals=true max-buffers=1 drop=true
 """
 
 pipeline_str = f"""
@@ -31,145 +53,330 @@ nvarguscamerasrc sensor_id={{idx}} !
 video/x-raw(memory:NVMM),width=1920,height=1080,framerate=30/1,format=NV12 !
 nvvidconv flip-method={{flip}} ! video/x-raw,width=960,height=720 !
 x264enc tune=zerolatency bitrate=4000 speed-preset=veryfast !
-h264parse config-interval=1 !
+h264parse config-interval=-1 !
 video/x-h264,stream-format=byte-stream,alignment=au !
-appsink name=sink emit-signals=true max-buffers=1 drop=true
+appsink name=sink{{idx}} emit-signals=true max-buffers=1 drop=true
 """
 
+import signal
 import threading
+from collections import deque
+from contextlib import ExitStack
 
+# Frames waiting for the MCAP writer thread. Kept small: when the writer falls
+# behind we drop the oldest frame, the same policy as the appsinks (drop=true).
+LOG_QUEUE_SIZE = 8
 
-def make_pipeline(idx: int):
-    """Create and return (pipeline, appsink) for camera index `idx`."""
+# H.264 is already compressed, so zstd (the SDK default) on MCAP chunks burns writer
+# CPU for almost no size reduction; lz4 costs next to nothing. MCAPWriteOptions
+# defaults to use_chunks=False, which would drop chunking, compression and the
+# message indexes Foxglove seeks with, so turn chunks back on explicitly.
+MCAP_WRITE_OPTIONS = MCAPWriteOptions(compression=MCAPCompression.Lz4, use_chunks=True)
+
+
+def make_pipeline(desc: str, indices):
+    """Parse `desc` and return (pipeline, {idx: appsink}) for the camera `indices`. The caller starts it."""
     try:
-        # Rotate camera 1 by 180 degrees, keep camera 0 as-is
-        flip_method = 2 if idx == 1 else 0
-        
-        raw = pipeline_str_mac if args.mac else pipeline_str
-        p = Gst.parse_launch(raw.format(idx=idx, flip=flip_method))
-        sink = p.get_by_name("sink")
-        p.set_state(Gst.State.PLAYING)
-        return p, sink
+        # FATAL_ERRORS makes a partially-parsed description (e.g. a missing element) raise
+        # here instead of returning a pipeline that only fails once it is started.
+        p = Gst.parse_launch_full(desc, None, Gst.ParseFlags.FATAL_ERRORS)
+        sinks = {}
+        for idx in indices:
+            sink = p.get_by_name(f"sink{idx}")
+            # Don't let appsink sync buffers against the clock before handing them over.
+            sink.set_property("sync", False)
+            sinks[idx] = sink
+        return p, sinks
     except Exception as e:
-        print(f"⚠️ Failed to create pipeline for index {idx}: {e}")
-        return None, None
+        print(f"⚠️ Failed to create pipeline for indices {indices}: {e}")
+        return None, {}
+
+
+def buffer_bytes(buf):
+    """Copy the contents of `buf` into one bytes object, or return None if it can't be mapped.
+
+    Each memory block is mapped on its own: a single block (the usual case) is copied once, and
+    several blocks are joined straight into the result instead of being merged by buf.map() first.
+    """
+    mapped = []
+    try:
+        for i in range(buf.n_memory()):
+            mem = buf.peek_memory(i)
+            ok, info = mem.map(Gst.MapFlags.READ)
+            if not ok:
+                return None
+            mapped.append((mem, info))
+        if len(mapped) == 1:
+            return bytes(mapped[0][1].data)
+        return b"".join(info.data for _, info in mapped)
+    finally:
+        for mem, info in mapped:
+            mem.unmap(info)
+
+
+def wall_clock_offset_ns(pipeline, samples: int = 5):
+    """Return the offset (ns) that converts `pipeline` running time, i.e. buffer PTS, to epoch time.
+
+    The clock read is bracketed by two wall-clock reads, and the tightest of `samples` brackets
+    is used, so a stall between the calls can't skew the result. Returns None without a clock.
+    """
+    clock = pipeline.get_clock()
+    if clock is None:
+        return None
+    base_ns = pipeline.get_base_time()
+    best = None
+    for _ in range(samples):
+        before = time.time_ns()
+        running_ns = clock.get_time() - base_ns
+        after = time.time_ns()
+        if best is None or after - before < best[0]:
+            best = (after - before, (before + after) // 2 - running_ns)
+    return best[1]
+
 
+def tune_streaming_thread(idx: int):
+    """Pin the calling thread to its own core and give it real-time priority, where the OS allows.
 
-# If --dual is provided, run two pipelines (camera_index and camera_index+1). Otherwise run one.
+    On Linux pid 0 means the calling thread. macOS has neither call, so this is a no-op there.
+    Threads created afterwards inherit both the CPU mask and SCHED_FIFO, so call this only once
+    the encoder/converter worker threads on this streaming thread already exist.
+    """
+    try:
+        os.sched_setaffinity(0, {idx % os.cpu_count()})
+    except AttributeError:
+        return
+    except OSError as e:
+        print(f"⚠️ Could not pin camera {idx} streaming thread: {e}")
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(20))
+    except OSError as e:
+        # needs root or CAP_SYS_NICE; the thread keeps the default policy
+        print(f"⚠️ Could not set real-time priority for camera {idx}: {e}")
+
+
+# If --dual is provided, capture cameras 0 and 1. Otherwise capture camera 0 only.
 indices = [0, 1] if args.dual else [0]
 
-pipelines = []
-appsinks = []
-for idx in indices:
-    p, s = make_pipeline(idx)
-    if p is None:
-        # if pipeline creation failed, stop starting more
-        continue
-    pipelines.append((idx, p))
-    appsinks.append((idx, s))
+# A single pipeline with a branch per camera, so every camera shares one clock
+# and base time and their PTS line up. The description is built once, up front.
+if args.mac:
+    pipeline_tpl = pipeline_str_mac
+elif args.nvenc:
+    pipeline_tpl = pipeline_str_nvenc
+else:
+    pipeline_tpl = pipeline_str
+# Rotate camera 1 by 180 degrees, keep camera 0 as-is
+pipeline_desc = "\n".join(pipeline_tpl.format(idx=idx, flip=2 if idx == 1 else 0) for idx in indices)
 
-mcap_file = f"capture_{time.strftime('%Y%m%d_%H%M%S')}.mcap"
+pipeline, appsinks = make_pipeline(pipeline_desc, indices)
 
-print(f"🎥 Recording webcam to {mcap_file}... Press Ctrl+C to stop")
+# One MCAP file per camera
+stamp = time.strftime('%Y%m%d_%H%M%S')
+mcap_files = {idx: f"capture_{stamp}_camera{idx}.mcap" for idx in appsinks}
 
-try:
-    # Create an explicit context and open the MCAP writer bound to it. This allows
-    # channels created with the same context to be recorded to the file.
-    ctx = foxglove.Context()
+print(f"🎥 Recording webcam to {', '.join(mcap_files.values())}... Press Ctrl+C to stop")
 
-    server = foxglove.start_server(context=ctx, host="0.0.0.0")
+try:
+    # Give every camera its own context, MCAP writer and channel, so the cameras never
+    # contend on one writer's lock. A websocket server serves a single context, so each
+    # camera also gets its own server: camera N on port 8765 + N.
+    servers = []
+    # The channels don't keep their foxglove.Context alive. Once a context is garbage
+    # collected its channel closes and logs are silently dropped, so hold every
+    # context here for the whole recording.
+    contexts = {}
 
-    # Open the MCAP writer once and keep it open while recording
-    with foxglove.open_mcap(mcap_file, context=ctx) as writer:
-        # Create one CompressedVideo channel per camera so they are separate in the MCAP
+    # Keep the MCAP writers open while recording
+    with ExitStack() as stack:
         channels = {}
-        for idx, _ in appsinks:
+        for idx in appsinks:
+            ctx = contexts[idx] = foxglove.Context()
+            servers.append(foxglove.start_server(context=ctx, host="0.0.0.0", port=8765 + idx))
+            stack.enter_context(foxglove.open_mcap(mcap_files[idx], context=ctx, writer_options=MCAP_WRITE_OPTIONS))
             topic = f"/camera/{idx}/image/compressed"
             channels[idx] = CompressedVideoChannel(topic=topic, context=ctx)
 
-        stop_event = threading.Event()
-        threads = []
+        # appsink hands each frame to its callback on the GStreamer streaming thread, so
+        # there are no Python capture threads; the main thread only runs the GLib loop.
+        loop = GLib.MainLoop()
+
+        # One epoch offset for the whole pipeline, shared by every camera: they run on one
+        # clock and base time, so a single measurement keeps their timestamps aligned. It
+        # is taken on the main thread once the pipeline is PLAYING; handlers wait for it.
+        wall_offset_ns = None
+        wall_offset_ready = threading.Event()
+
+        def start_writer(idx, channel):
+            """Start the writer thread for camera `idx`; return (enqueue, thread).
+
+            The appsink callback only enqueues messages and the writer thread does the
+            channel.log calls, so serialisation and disk writes never stall a streaming thread.
+            """
+            # deque append/popleft are atomic under the GIL, so the hand-off needs no lock of
+            # its own; maxlen drops the oldest frame when full. The event wakes the writer.
+            log_queue = deque(maxlen=LOG_QUEUE_SIZE)
+            log_ready = threading.Event()
+
+            def enqueue(msg):
+                """Queue `msg`, or None to stop the writer, dropping the oldest entry when full."""
+                log_queue.append(msg)
+                log_ready.set()
+
+            def writer_loop():
+                """Log queued messages to `channel` until the None sentinel is dequeued."""
+                while True:
+                    log_ready.wait()
+                    # Clear before draining: anything queued after this sets the event again,
+                    # and everything queued before the sentinel is logged.
+                    log_ready.clear()
+                    while log_queue:
+                        msg = log_queue.popleft()
+                        if msg is None:
+                            return
+
+                        try:
+                            channel.log(msg)
+                        except Exception as e:
+                            # If logging fails (writer closed etc), stop
+                            print(f"⚠️ Failed to log frame for camera {idx}: {e}")
+                            loop.quit()
+                            return
+
+            t = threading.Thread(target=writer_loop, daemon=True)
+            t.start()
+            return enqueue, t
+
+        def make_sample_handler(idx, enqueue):
+            """Return an appsink "new-sample" handler that passes camera `idx` frames to `enqueue`."""
+            # frame_id names the camera; it is the same object every frame, so
+            # nothing is formatted on the hot path. Per-frame ordering comes from the timestamp.
+            frame_id = f"cam{idx}"
+            # the shared pipeline offset, fetched on this camera's first frame
+            offset_ns = None
+            # The streaming thread is tuned on the first frame rather than when it starts:
+            # by then caps have reached the encoder/converter and their worker threads
+            # exist, so they don't inherit this thread's single-core mask and SCHED_FIFO.
+            tuned = False
 
-        def capture_loop(idx, sink, channel):
-            """Pull samples from a single appsink and log them to the provided channel."""
-            frame_seq_local = 0
-            while not stop_event.is_set():
-                try:
-                    sample = sink.emit("pull-sample")
-                except Exception:
-                    # appsink might raise when pipeline stops; break to exit cleanly
-                    break
+            # Bind what the handler uses on every frame, so each use is a closure-cell load
+            # rather than a global lookup plus an attribute lookup.
+            flow_ok = Gst.FlowReturn.OK
+            clock_time_none = Gst.CLOCK_TIME_NONE
+            time_ns = time.time_ns
+            copy_buffer = buffer_bytes
+            new_timestamp = Timestamp
+            new_msg = CompressedVideo
 
+            def on_new_sample(sink):
+                # Runs on the pipeline's streaming thread; a sample is ready, so this doesn't block.
+                nonlocal offset_ns, tuned
+                if not tuned:
+                    tune_streaming_thread(idx)
+                    tuned = True
+                sample = sink.pull_sample()
                 if sample is None:
-                    # small sleep to avoid busy-loop when no frames
-                    time.sleep(0.001)
-                    continue
+                    return Gst.FlowReturn.EOS
 
                 buf = sample.get_buffer()
                 if buf is None:
-                    continue
+                    return flow_ok
 
-                data = buf.extract_dup(0, buf.get_size())
+                # Map the buffer instead of extract_dup: extract_dup copies into a GLib
+                # allocation and then again into a Python bytes object. The Foxglove
+                # schema types only accept owning bytes, so keep exactly one copy.
+                data = copy_buffer(buf)
+                if data is None:
+                    return flow_ok
 
-                # prefer PTS (presentation timestamp) as a stable frame identifier
+                # Stamp frames with their capture time from the PTS rather than the
+                # wall clock at pull time, so timestamps are monotonic and in ns.
                 pts = buf.pts
-                if pts != Gst.CLOCK_TIME_NONE:
-                    frame_id = f"pts:{int(pts)}"
+                if offset_ns is None:
+                    wall_offset_ready.wait()
+                    offset_ns = wall_offset_ns
+                if pts != clock_time_none and offset_ns is not None:
+                    ts_ns = offset_ns + pts
                 else:
-                    dts = buf.dts
-                    if dts != Gst.CLOCK_TIME_NONE:
-                        frame_id = f"dts:{int(dts)}"
-                    else:
-                        frame_seq_local += 1
-                        frame_id = f"seq:{frame_seq_local}"
+                    ts_ns = time_ns()
+                timestamp_ns = new_timestamp(ts_ns // 1_000_000_000, ts_ns % 1_000_000_000)
 
-                timestamp_ns = Timestamp.from_epoch_secs(time.time())
-
-                img_msg = CompressedVideo(
+                # Foxglove schema objects are immutable and copy their fields when built,
+                # so a preallocated message can't be refilled in place. Only data and
+                # timestamp change per frame; frame_id is the same string every time.
+                img_msg = new_msg(
                     timestamp=timestamp_ns,
                     data=data,
                     format="h264",
                     frame_id=frame_id,
                 )
 
-                try:
-                    channel.log(img_msg)
-                except Exception as e:
-                    # If logging fails (writer closed etc), stop
-                    print(f"⚠️ Failed to log frame for camera {idx}: {e}")
-                    break
-
-        # Start one thread per active appsink
-        for idx, sink in appsinks:
-            ch = channels.get(idx)
-            if ch is None or sink is None:
-                continue
-            t = threading.Thread(target=capture_loop, args=(idx, sink, ch), daemon=True)
-            threads.append(t)
-            t.start()
+                enqueue(img_msg)
+                return flow_ok
 
-        print(f"Started {len(threads)} capture thread(s)")
+            return on_new_sample
 
-        # Wait until interrupted
-        try:
-            while any(t.is_alive() for t in threads):
-                time.sleep(0.1)
-        except KeyboardInterrupt:
+        def on_sigint():
+            """Quit the main loop on Ctrl+C."""
             print("\n🛑 Stopping recording...")
-            stop_event.set()
-            # give threads time to finish
-            for t in threads:
-                t.join(timeout=1.0)
+            loop.quit()
+            return GLib.SOURCE_REMOVE
+
+        # Let GLib dispatch SIGINT on the main loop, so the main thread just sleeps in
+        # loop.run() until there is something to do.
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, on_sigint)
+
+        def on_bus_message(bus, message):
+            """Quit the main loop when the pipeline hits EOS or an error."""
+            if message.type == Gst.MessageType.ERROR:
+                err, _ = message.parse_error()
+                print(f"⚠️ Pipeline failed: {err.message}")
+            loop.quit()
+
+        writers = []
+        for idx, sink in appsinks.items():
+            enqueue, writer_thread = start_writer(idx, channels[idx])
+            writers.append((enqueue, writer_thread))
+            sink.connect("new-sample", make_sample_handler(idx, enqueue))
+
+        if pipeline is not None:
+            bus = pipeline.get_bus()
+            bus.add_signal_watch()
+            bus.connect("message::eos", on_bus_message)
+            bus.connect("message::error", on_bus_message)
+
+        try:
+            if pipeline is not None:
+                if pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+                    print("⚠️ Failed to start the pipeline")
+                else:
+                    # Wait for PLAYING so the pipeline clock and base time are set.
+                    pipeline.get_state(5 * Gst.SECOND)
+                    wall_offset_ns = wall_clock_offset_ns(pipeline)
+                    wall_offset_ready.set()
+                    print(f"Recording from {len(appsinks)} camera(s)")
+                    # Wait until interrupted
+                    loop.run()
+        finally:
+            # release any handler still waiting for the offset, so stopping can't deadlock
+            wall_offset_ready.set()
+            # stop the pipeline so nothing new is queued, then let the writers drain
+            # what's left before the MCAP files are closed
+            if pipeline is not None:
+                pipeline.set_state(Gst.State.NULL)
+            for enqueue, _ in writers:
+                enqueue(None)
+            for _, writer_thread in writers:
+                writer_thread.join(timeout=1.0)
 
 except Exception as e:
     print(f"Unexpected error: {e}")
     raise
 
 finally:
-    # Tear down pipelines
-    for idx, p in pipelines:
+    # Tear down the pipeline
+    if pipeline is not None:
         try:
-            p.set_state(Gst.State.NULL)
+            pipeline.set_state(Gst.State.NULL)
         except Exception:
             pass
-    print("✅ Recording saved to", mcap_file)
\ No newline at end of file
+    print("✅ Recording saved to", ", ".join(mcap_files.values()))
\ No newline at end of file